@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import struct
 import io
+import mmap
 import re
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
@@ -10,21 +12,46 @@ import numpy as np
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import warnings
 import requests
+from requests.adapters import HTTPAdapter
+import tempfile
 import traceback
 from PIL import Image
- 
+
+# glymur (OpenJPEG bindings) decodes JP2 several times faster than PIL's
+# single-threaded codec. Optional: the PIL path is used when unavailable.
+try:
+    import glymur
+    glymur.set_option('lib.num_threads', os.cpu_count() or 1)
+    _HAS_GLYMUR = True
+except Exception:
+    _HAS_GLYMUR = False
+
 
 warnings.filterwarnings('ignore')
 
-# Set this to False to skip saving local debug images and save processing time
-SAVE_DEBUG_IMAGES = False
+# Shared session so the per-wavelength requests reuse pooled keep-alive
+# connections instead of paying a TCP/TLS handshake each.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+_SESSION.mount('https://', _ADAPTER)
+_SESSION.mount('http://', _ADAPTER)
+
+# Debug images are off by default; set SOLAR_DEBUG=1 to save them locally.
+# Each PNG encode costs 50-150 ms, so they stay off the production path.
+SAVE_DEBUG_IMAGES = bool(os.environ.get('SOLAR_DEBUG'))
+
+# Precompiled container header formats: version byte + 19-char ascii
+# timestamp, then (width, height) ahead of each RGB frame.
+_HEADER_STRUCT = struct.Struct('<B19s')
+_DIMS_STRUCT = struct.Struct('<HH')
 
 
 def save_debug_image(image_array, filename):
     debug_dir = Path(__file__).parent / 'debug_images'
     debug_dir.mkdir(parents=True, exist_ok=True)
     image_path = debug_dir / filename
-    Image.fromarray(image_array).save(image_path)
+    # compress_level=1 cuts libpng time ~4x; debug images don't need small files
+    Image.fromarray(image_array).save(image_path, compress_level=1)
 
 
 def list_hmi_candidates(max_days=1):
@@ -35,7 +62,7 @@ def list_hmi_candidates(max_days=1):
         d = now + timedelta(days=day_offset)
         base_url = f'https://jsoc1.stanford.edu/data/hmi/images/{d.year}/{d.month:02d}/{d.day:02d}/'
         try:
-            r = requests.get(base_url, timeout=10)
+            r = _SESSION.get(base_url, timeout=10)
             if r.status_code != 200:
                 continue
             matches = re.findall(r'href="([0-9_]+_M_4k\.jpg)"', r.text)
@@ -60,7 +87,7 @@ def list_aia_candidates(wavelength, max_days=1):
         h = now + timedelta(days=day_offset)
         base_url = f"http://jsoc.stanford.edu/data/aia/images/{h.year}/{h.month:02d}/{h.day:02d}/{wavelength}/"
         try:
-            r = requests.get(base_url, timeout=10)
+            r = _SESSION.get(base_url, timeout=10)
             if r.status_code != 200:
                 continue
             matches = re.findall(r'href="([^\"]+\.jp2)"', r.text)
@@ -81,13 +108,35 @@ def list_aia_candidates(wavelength, max_days=1):
     return out
 
 
+def decode_jp2(jp2_bytes):
+    """Decode JP2 bytes with glymur/OpenJPEG. glymur only reads from paths, so
+    stage the bytes in tmpfs when available to keep the round trip in RAM."""
+    tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    with tempfile.NamedTemporaryFile(suffix='.jp2', dir=tmp_dir) as tmp:
+        tmp.write(jp2_bytes)
+        tmp.flush()
+        jp2 = glymur.Jp2k(tmp.name)
+        # JP2 is wavelet-encoded: decoding a 4096^2 frame at resolution
+        # level 1 yields 2048^2 natively, so no separate resize is needed.
+        # glymur maps step-2 slicing to a level-1 decode.
+        if jp2.shape[:2] == (4096, 4096):
+            return jp2[::2, ::2]
+        return jp2[:]
+
+
 def download_aia_by_url(url, wavelength):
-    """Download a JP2 by URL and process to 2048 grayscale array, returning (flattened, timestamp, wl, w, h)."""
+    """Download a JP2 by URL and process to 2048 grayscale array, returning (array, timestamp, wl, w, h)."""
     try:
-        r = requests.get(url, timeout=60)
+        r = _SESSION.get(url, timeout=60)
         r.raise_for_status()
-        from io import BytesIO
-        img = Image.open(BytesIO(r.content))
+        if _HAS_GLYMUR:
+            img = Image.fromarray(decode_jp2(r.content))
+        else:
+            img = Image.open(io.BytesIO(r.content))
+            # same trick via PIL: decode 4096^2 sources one wavelet level down
+            if img.size == (4096, 4096):
+                img.reduce = 1
+                img.load()
 
         # attempt to parse timestamp from filename
         fn = url.rsplit('/', 1)[-1]
@@ -104,13 +153,14 @@ def download_aia_by_url(url, wavelength):
 
         if img.mode == 'RGB':
             img = img.convert('L')
-        img = img.resize((2048, 2048), Image.Resampling.LANCZOS)
-        arr = np.array(img)
+        if img.size != (2048, 2048):
+            img = img.resize((2048, 2048), Image.Resampling.LANCZOS)
+        arr = np.asarray(img)
 
         if SAVE_DEBUG_IMAGES:
             save_debug_image(arr, f'AIA_{wavelength}_{ts.strftime("%Y%m%d_%H%M%S")}.png')
 
-        return arr.flatten(), ts, wavelength, 2048, 2048
+        return arr, ts, wavelength, 2048, 2048
     except Exception as e:
         print(f"Error downloading AIA by URL {url}: {e}")
         traceback.print_exc()
@@ -118,9 +168,9 @@ def download_aia_by_url(url, wavelength):
 
 
 def download_hmi_by_url(url):
-    """Download HMI jpg by URL and return flattened array and timestamp."""
+    """Download HMI jpg by URL and return 2048 grayscale array and timestamp."""
     try:
-        r = requests.get(url, timeout=60)
+        r = _SESSION.get(url, timeout=60)
         r.raise_for_status()
         img = Image.open(io.BytesIO(r.content))
         # parse timestamp
@@ -134,30 +184,28 @@ def download_hmi_by_url(url):
         if img.mode == 'RGB':
             img = img.convert('L')
         img = img.resize((2048, 2048), Image.Resampling.LANCZOS)
-        arr = np.array(img)
+        arr = np.asarray(img)
 
         if SAVE_DEBUG_IMAGES:
             save_debug_image(arr, f'HMI_{ts.strftime("%Y%m%d_%H%M%S")}.png')
 
-        return arr.flatten(), ts, 2048, 2048
+        return arr, ts, 2048, 2048
     except Exception as e:
         print(f"Error downloading HMI by URL {url}: {e}")
         traceback.print_exc()
         return None, None, 0, 0
 
 
-def create_rgb_image(r_channel, g_channel, b_channel):
-    if len(r_channel) != len(g_channel) or len(g_channel) != len(b_channel):
-        raise ValueError("All channels must have the same length")
-    
-    pixel_count = len(r_channel)
-    rgb_data = np.empty(pixel_count * 3, dtype=np.uint8)
-    
-    rgb_data[0::3] = r_channel
-    rgb_data[1::3] = g_channel
-    rgb_data[2::3] = b_channel
-    
-    return rgb_data.tobytes()
+def create_rgb_image(r_channel, g_channel, b_channel, out):
+    """Interleave three grayscale channels into `out`, a (H, W, 3) uint8 array."""
+    if r_channel.shape != g_channel.shape or g_channel.shape != b_channel.shape:
+        raise ValueError("All channels must have the same shape")
+
+    # Three direct channel assignments; numpy's SIMD copy loops handle the
+    # planar-to-interleaved shuffle without np.stack's concatenate overhead.
+    out[..., 0] = r_channel
+    out[..., 1] = g_channel
+    out[..., 2] = b_channel
 
 
 def create_container_file(timestamp, downloads):
@@ -171,38 +219,47 @@ def create_container_file(timestamp, downloads):
         raise Exception(f"Missing wavelengths for container: {missing}")
 
     ordered_downloads = [download_dict[wl] for wl in wavelength_order]
-    
+
     width, height = 2048, 2048
-    rgb_image_0 = create_rgb_image(
-        ordered_downloads[0][0],
-        ordered_downloads[1][0],
-        ordered_downloads[2][0]
-    )
-    
-    rgb_image_1 = create_rgb_image(
-        ordered_downloads[3][0],
-        ordered_downloads[4][0],
-        ordered_downloads[5][0]
-    )
-
-    if SAVE_DEBUG_IMAGES:
-        rgb0 = np.frombuffer(rgb_image_0, dtype=np.uint8).reshape((2048, 2048, 3))
-        rgb1 = np.frombuffer(rgb_image_1, dtype=np.uint8).reshape((2048, 2048, 3))
-        save_debug_image(rgb0, f'RGB_0_{timestamp.strftime("%Y%m%d_%H%M%S")}.png')
-        save_debug_image(rgb1, f'RGB_1_{timestamp.strftime("%Y%m%d_%H%M%S")}.png')
-    
-    with open(container_path, 'wb') as f:
-        f.write(struct.pack('B', 2))
-        timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        f.write(timestamp_str.encode('ascii'))
-        
-        f.write(struct.pack('<H', width))
-        f.write(struct.pack('<H', height))
-        f.write(rgb_image_0)
-        
-        f.write(struct.pack('<H', width))
-        f.write(struct.pack('<H', height))
-        f.write(rgb_image_1)
+    frame_bytes = width * height * 3
+    total_size = _HEADER_STRUCT.size + 2 * (_DIMS_STRUCT.size + frame_bytes)
+
+    # mmap the container at its final size and interleave the channels
+    # directly into the file, so no intermediate RGB bytes objects exist.
+    with open(container_path, 'w+b') as f:
+        f.truncate(total_size)
+        with mmap.mmap(f.fileno(), total_size, access=mmap.ACCESS_WRITE) as mm:
+            timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
+            _HEADER_STRUCT.pack_into(mm, 0, 2, timestamp_str.encode('ascii'))
+
+            rgb_views = []
+            offset = _HEADER_STRUCT.size
+            for _ in range(2):
+                _DIMS_STRUCT.pack_into(mm, offset, width, height)
+                offset += _DIMS_STRUCT.size
+                view = np.frombuffer(mm, dtype=np.uint8, count=frame_bytes, offset=offset)
+                rgb_views.append(view.reshape((height, width, 3)))
+                offset += frame_bytes
+
+            create_rgb_image(
+                ordered_downloads[0][0],
+                ordered_downloads[1][0],
+                ordered_downloads[2][0],
+                out=rgb_views[0]
+            )
+            create_rgb_image(
+                ordered_downloads[3][0],
+                ordered_downloads[4][0],
+                ordered_downloads[5][0],
+                out=rgb_views[1]
+            )
+
+            if SAVE_DEBUG_IMAGES:
+                save_debug_image(rgb_views[0], f'RGB_0_{timestamp.strftime("%Y%m%d_%H%M%S")}.png')
+                save_debug_image(rgb_views[1], f'RGB_1_{timestamp.strftime("%Y%m%d_%H%M%S")}.png')
+
+            # release the numpy views before the mmap closes
+            del view, rgb_views
 
 
 def main():
@@ -289,7 +346,7 @@ def main():
             if kind == 'aia':
                 downloads.append(res)
             else:
-                # download_hmi_by_url returns (flattened, ts, w, h)
+                # download_hmi_by_url returns (arr, ts, w, h)
                 arr, ts, w, h = res
                 downloads.append((arr, ts, 'HMI', w, h))
 